@@ -0,0 +1,437 @@
+## analytics.py
+#
+# Host-side (CPython + NumPy) analysis of logs pulled off the stations.
+# Not uploaded to the ESP32.
+#
+# Input is JSON lines, one record per line:
+#   {"station": "coop1", "ts": 1234, "kind": "reading",  "data": <Monitor.read_all() dict>}
+#   {"station": "coop1", "ts": 1234, "kind": "health",   "data": <log['health'] dict>}
+#   {"station": "coop1", "ts": 1234, "kind": "recovery", "data": <log['recoveries'] entry>}
+#   {"station": "coop1", "ts": 1234, "kind": "sensors",
+#    "data": {"ds18b20": {"sensors": <log['ds18b20']['sensors']>}}}
+# "sensors" records say how many DS probes a station has fitted, so a probe
+# that was never fitted is not reported as always failing.
+# Files ending in .bin are read as binary telemetry frames (telemetry.py),
+# e.g. a station's flash buffer; their numeric station ids become strings.
+# Timestamps are kept as exported (device time.time(), i.e. seconds since
+# 2000-01-01 on the ESP32 port; add MICROPY_EPOCH_OFFSET for Unix time).
+#
+# `ingest` converts the exports once into per-column .npy files; `load`
+# memory-maps them back so large archives open without copying. New exports
+# are merged into an existing archive with --append; station indices are kept.
+#
+# Usage:
+#   python analytics.py ingest archive/ coop1.jsonl coop2.jsonl
+#   python analytics.py ingest --append archive/ new_week.jsonl
+#   python analytics.py summary archive/ --period 3600 --max-gap 900
+
+import os
+import sys
+import json
+import argparse
+from array import array
+
+import numpy as np
+
+import telemetry
+
+MICROPY_EPOCH_OFFSET = 946684800
+# 2020-01-01 in device (2000) epoch; anything earlier means the station never
+# synced NTP. Unix-epoch exports are well above it too.
+MIN_VALID_TS = 631152000
+_STATION_SHIFT = 40  # bin key = station << 40 | bin index
+
+# Virtual pins written by Monitor.read_all()
+CHANNELS = ('V0', 'V1', 'V2', 'V3', 'V4')
+CHANNEL_NAMES = {
+    'V0': 'ds18b20_0',
+    'V1': 'ds18b20_1',
+    'V2': 'bme_temp',
+    'V3': 'bme_pressure',
+    'V4': 'bme_humidity',
+}
+SENSORS = ('ds18b20', 'bme280')
+STREAK_COLUMNS = {'ds18b20': 'ds_fail_streak', 'bme280': 'bme_fail_streak'}
+TABLES = ('readings', 'health', 'recoveries', 'sensors')
+
+
+def _write_table(path, columns, order=None):
+    """Write one .npy per column; each file is replaced atomically, so arrays
+    still memory-mapped from the old archive stay valid."""
+    os.makedirs(path, exist_ok=True)
+    for name, col in columns.items():
+        arr = np.asarray(col)
+        if order is not None:
+            arr = arr[order]
+        dest = os.path.join(path, name + '.npy')
+        with open(dest + '.tmp', 'wb') as f:
+            np.save(f, arr)
+        os.replace(dest + '.tmp', dest)
+
+
+def _ingest_frames(path, stations, rd):
+    with open(path, 'rb') as f:
+        cols = telemetry.decode_frames(f.read())
+    n = len(cols['ts'])
+    if n == 0:
+        return
+    ids = np.unique(cols['station'])
+    lut = np.zeros(int(ids.max()) + 1, dtype=np.uint16)
+    for s in ids.tolist():
+        lut[s] = stations.setdefault(str(s), len(stations))
+    rd['station'].frombytes(lut[cols['station']].tobytes())
+    rd['ts'].frombytes(cols['ts'].astype(np.float64).tobytes())
+    for ch in CHANNELS:
+        col = cols[ch] if ch in cols else np.full(n, np.nan)
+        rd[ch].frombytes(col.astype(np.float32).tobytes())
+
+
+def ingest(out_dir, paths, append=False):
+    """Convert JSON-lines exports (and .bin telemetry files) into a columnar archive at out_dir.
+
+    Tables are sorted by (station, ts). An existing archive is only touched
+    with append=True: its rows are merged with the new ones and station
+    indices are kept. Returns a dict of rows added per table.
+    """
+    stations_path = os.path.join(out_dir, 'stations.json')
+    existing = os.path.exists(stations_path)
+    if existing and not append:
+        raise FileExistsError(f'{out_dir} already holds an archive; use append=True to add to it')
+    stations = {}
+    if existing:
+        with open(stations_path) as f:
+            stations = {name: i for i, name in enumerate(json.load(f))}
+
+    rd = {'station': array('H'), 'ts': array('d')}
+    for ch in CHANNELS:
+        rd[ch] = array('f')
+    hl = {'station': array('H'), 'ts': array('d'),
+          'ds_fail_streak': array('i'), 'bme_fail_streak': array('i')}
+    rc = {'station': array('H'), 'ts': array('d'),
+          'sensor': array('b'), 'ok': array('b')}
+    sn = {'station': array('H'), 'ts': array('d'), 'ds_sensors': array('b')}
+    nan = float('nan')
+
+    for path in paths:
+        if path.endswith('.bin'):
+            _ingest_frames(path, stations, rd)
+            continue
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                rec = json.loads(line)
+                sid = stations.setdefault(rec.get('station', ''), len(stations))
+                data = rec.get('data') or {}
+                kind = rec.get('kind', 'reading')
+                if kind == 'reading':
+                    rd['station'].append(sid)
+                    rd['ts'].append(rec['ts'])
+                    for ch in CHANNELS:
+                        v = data.get(ch)
+                        rd[ch].append(nan if v is None else v)
+                elif kind == 'health':
+                    hl['station'].append(sid)
+                    hl['ts'].append(rec['ts'])
+                    hl['ds_fail_streak'].append(data.get('ds_fail_streak', 0))
+                    hl['bme_fail_streak'].append(data.get('bme_fail_streak', 0))
+                elif kind == 'recovery':
+                    sensor = data.get('sensor')
+                    rc['station'].append(sid)
+                    rc['ts'].append(data.get('timestamp', rec.get('ts')))
+                    rc['sensor'].append(SENSORS.index(sensor) if sensor in SENSORS else -1)
+                    rc['ok'].append(1 if data.get('ok') else 0)
+                elif kind == 'sensors':
+                    sn['station'].append(sid)
+                    sn['ts'].append(rec['ts'])
+                    sn['ds_sensors'].append(min((data.get('ds18b20') or {}).get('sensors', 0), 127))
+
+    os.makedirs(out_dir, exist_ok=True)
+    counts = {}
+    for name, cols in zip(TABLES, (rd, hl, rc, sn)):
+        cols = {k: np.frombuffer(v, dtype=v.typecode) for k, v in cols.items()}
+        counts[name] = len(cols['ts'])
+        path = os.path.join(out_dir, name)
+        if existing and os.path.isdir(path):
+            old = {k: np.load(os.path.join(path, k + '.npy'), mmap_mode='r') for k in cols}
+            cols = {k: np.concatenate((old[k], v)) for k, v in cols.items()}
+        _write_table(path, cols, np.lexsort((cols['ts'], cols['station'])))
+    with open(stations_path + '.tmp', 'w') as f:
+        json.dump(sorted(stations, key=stations.get), f)
+    os.replace(stations_path + '.tmp', stations_path)
+    return counts
+
+
+def load(archive_dir):
+    """Memory-map an archive written by ingest().
+
+    Returns {'stations': [...], 'readings': {col: array}, 'health': {...},
+    'recoveries': {...}, 'sensors': {...}}; arrays are read-only np.memmap views.
+    """
+    out = {}
+    with open(os.path.join(archive_dir, 'stations.json')) as f:
+        out['stations'] = json.load(f)
+    for name in TABLES:
+        path = os.path.join(archive_dir, name)
+        table = {}
+        if os.path.isdir(path):
+            for fn in os.listdir(path):
+                if fn.endswith('.npy'):
+                    table[fn[:-4]] = np.load(os.path.join(path, fn), mmap_mode='r')
+        out[name] = table
+    return out
+
+
+# --- analytics ---------------------------------------------------------
+def _bin_keys(station, ts, period):
+    """Return (keys, inverse) for the occupied (station, period bin) cells.
+
+    Only occupied cells exist, so memory follows the row count rather than
+    the time span. Rows sorted by (station, ts), as ingest() writes them,
+    skip the sort in np.unique.
+    """
+    key = (station.astype(np.int64) << _STATION_SHIFT) | (ts // period).astype(np.int64)
+    if len(key) and np.all(key[1:] >= key[:-1]):
+        new = np.empty(len(key), dtype=bool)
+        new[0] = True
+        np.not_equal(key[1:], key[:-1], out=new[1:])
+        return key[new], np.cumsum(new) - 1
+    return np.unique(key, return_inverse=True)
+
+
+def _bin_mean(inverse, n_cells, values):
+    values = np.asarray(values, dtype=np.float64)
+    good = ~np.isnan(values)
+    sums = np.bincount(inverse[good], weights=values[good], minlength=n_cells)
+    counts = np.bincount(inverse[good], minlength=n_cells)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return sums / counts
+
+
+def resample(station, ts, values, period):
+    """Mean of values in `period`-second bins, per station.
+
+    Returns (station, bin_start, mean) arrays for occupied bins only; a bin
+    whose values are all NaN has a NaN mean.
+    """
+    keys, inverse = _bin_keys(station, ts, period)
+    means = _bin_mean(inverse, len(keys), values)
+    return ((keys >> _STATION_SHIFT).astype(np.uint16),
+            (keys & ((1 << _STATION_SHIFT) - 1)) * float(period), means)
+
+
+def find_gaps(station, ts, max_gap):
+    """Find reporting gaps longer than max_gap seconds.
+
+    Expects rows sorted by (station, ts), as written by ingest(). Returns
+    (station, gap_start, gap_end) arrays.
+    """
+    if len(ts) < 2:
+        empty = np.empty(0)
+        return empty.astype(np.uint16), empty, empty
+    dt = np.diff(ts)
+    same = station[1:] == station[:-1]
+    idx = np.nonzero(same & (dt > max_gap))[0]
+    return np.asarray(station[idx]), np.asarray(ts[idx]), np.asarray(ts[idx + 1])
+
+
+def missing_counts(readings, n_stations):
+    """Return (readings per station, {channel_name: readings without that channel})."""
+    st = readings['station']
+    total = np.bincount(st, minlength=n_stations)
+    missing = {}
+    for ch in CHANNELS:
+        if ch in readings:
+            missing[CHANNEL_NAMES[ch]] = np.bincount(
+                st, weights=np.isnan(readings[ch]), minlength=n_stations).astype(np.int64)
+    return total, missing
+
+
+def fitted_channels(sensors, n_stations):
+    """{channel_name: bool array} of channels each station has hardware for.
+
+    DS probe k counts as fitted if any 'sensors' record of the station
+    reported more than k probes. Stations without such records, and the BME
+    channels, count as fitted, so a sensor that never answers shows up as
+    failing rather than absent.
+    """
+    fitted = {name: np.ones(n_stations, dtype=bool) for name in CHANNEL_NAMES.values()}
+    st = np.asarray(sensors.get('station', np.empty(0, np.uint16)))
+    if not len(st):
+        return fitted
+    probes = np.full(n_stations, -1, dtype=np.int16)
+    np.maximum.at(probes, st, np.asarray(sensors['ds_sensors']))
+    for k, ch in enumerate(('V0', 'V1')):
+        fitted[CHANNEL_NAMES[ch]] = (probes < 0) | (probes > k)
+    return fitted
+
+
+def failure_rates(readings, n_stations, fitted=None):
+    """Fraction of readings with each channel missing, per station.
+
+    Returns {channel_name: array of shape (n_stations,)}. A channel that is
+    always missing has rate 1.0; NaN is reserved for stations with no
+    readings and for channels `fitted` (see fitted_channels) marks absent.
+    """
+    total, missing = missing_counts(readings, n_stations)
+    rates = {}
+    for name, miss in missing.items():
+        with np.errstate(invalid='ignore', divide='ignore'):
+            rate = miss / total
+        if fitted is not None:
+            rate[~fitted[name]] = np.nan
+        rates[name] = rate
+    return rates
+
+
+def sensor_health(health, recoveries, n_stations):
+    """Per-sensor failure figures from health snapshots and recovery outcomes.
+
+    Returns {sensor: {'failing': fraction of health snapshots with a non-zero
+    fail streak, 'recoveries': re-init attempts, 'recovery_failures': attempts
+    with ok False}}, each an array of shape (n_stations,).
+    """
+    out = {}
+    hst = health.get('station', np.empty(0, np.uint16))
+    snapshots = np.bincount(hst, minlength=n_stations).astype(np.float64)
+    rst = recoveries.get('station', np.empty(0, np.uint16))
+    rsensor = recoveries.get('sensor', np.empty(0, np.int8))
+    rok = recoveries.get('ok', np.empty(0, np.int8))
+    for i, sensor in enumerate(SENSORS):
+        streak = health.get(STREAK_COLUMNS[sensor])
+        if streak is None:
+            failing = np.full(n_stations, np.nan)
+        else:
+            bad = np.bincount(hst, weights=np.asarray(streak) > 0, minlength=n_stations)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                failing = bad / snapshots
+        sel = np.asarray(rsensor) == i
+        out[sensor] = {
+            'failing': failing,
+            'recoveries': np.bincount(rst[sel], minlength=n_stations),
+            'recovery_failures': np.bincount(rst[sel], weights=np.asarray(rok)[sel] == 0,
+                                             minlength=n_stations).astype(np.int64),
+        }
+    return out
+
+
+def recovery_correlation(readings, recoveries, period):
+    """Correlate binned recovery counts with BME temperature and humidity.
+
+    Readings and recoveries share the same per-station `period` bins; returns
+    {sensor: {'temp': r, 'humidity': r, 'events': n}} with Pearson r over the
+    occupied bins (NaN if undefined). Recoveries in bins with no reading are
+    not counted.
+    """
+    st, ts = readings['station'], readings['ts']
+    if len(ts) == 0:
+        return {}
+    keys, inverse = _bin_keys(st, ts, period)
+    temp = _bin_mean(inverse, len(keys), readings['V2'])
+    hum = _bin_mean(inverse, len(keys), readings['V4'])
+
+    rkey = ((np.asarray(recoveries['station']).astype(np.int64) << _STATION_SHIFT)
+            | (np.asarray(recoveries['ts']) // period).astype(np.int64))
+    pos = np.minimum(np.searchsorted(keys, rkey), len(keys) - 1)
+    inside = keys[pos] == rkey
+    rsensor = np.asarray(recoveries['sensor'])
+    out = {}
+    for i, sensor in enumerate(SENSORS):
+        sel = inside & (rsensor == i)
+        events = np.bincount(pos[sel], minlength=len(keys)).astype(np.float64)
+        res = {'events': int(sel.sum())}
+        for label, series in (('temp', temp), ('humidity', hum)):
+            good = ~np.isnan(series)
+            x, y = events[good], series[good]
+            if len(x) < 2 or x.std() == 0 or y.std() == 0:
+                res[label] = float('nan')
+            else:
+                res[label] = float(np.corrcoef(x, y)[0, 1])
+        out[sensor] = res
+    return out
+
+
+def _valid_rows(table):
+    """Drop rows stamped before MIN_VALID_TS; returns (table, dropped)."""
+    ts = table.get('ts')
+    if ts is None or not len(ts):
+        return table, 0
+    ok = np.asarray(ts) >= MIN_VALID_TS
+    dropped = int(len(ok) - ok.sum())
+    if dropped:
+        table = {k: np.asarray(v)[ok] for k, v in table.items()}
+    return table, dropped
+
+
+def _json_safe(obj):
+    """Map NaN/inf to None and NumPy scalars to Python for strict JSON."""
+    if isinstance(obj, dict):
+        return {k: _json_safe(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_json_safe(v) for v in obj]
+    if isinstance(obj, np.generic):
+        obj = obj.item()
+    if isinstance(obj, float) and (obj != obj or obj in (float('inf'), float('-inf'))):
+        return None
+    return obj
+
+
+def summary(archive, period=3600, max_gap=900):
+    """Compute the standard report over a loaded archive.
+
+    Rows timestamped before MIN_VALID_TS (no NTP sync) are left out and
+    counted under 'unsynced_rows'. NaN values are reported as None.
+    """
+    stations = archive['stations']
+    n = len(stations)
+    rd, rd_bad = _valid_rows(archive['readings'])
+    hl, hl_bad = _valid_rows(archive['health'])
+    rc, rc_bad = _valid_rows(archive['recoveries'])
+    fitted = fitted_channels(archive.get('sensors', {}), n)
+    total, missing = missing_counts(rd, n)
+
+    def per_station(arr):
+        return dict(zip(stations, arr.tolist()))
+
+    gap_st, gap_start, gap_end = find_gaps(rd['station'], rd['ts'], max_gap)
+    return _json_safe({
+        'stations': stations,
+        'readings': len(rd['ts']),
+        'unsynced_rows': {'readings': rd_bad, 'health': hl_bad, 'recoveries': rc_bad},
+        'readings_per_station': per_station(total),
+        'missing': {k: per_station(v) for k, v in missing.items()},
+        'failure_rates': {k: per_station(v) for k, v in failure_rates(rd, n, fitted).items()},
+        'sensor_health': {sensor: {k: per_station(v) for k, v in figures.items()}
+                          for sensor, figures in sensor_health(hl, rc, n).items()},
+        'gaps': [{'station': stations[s], 'start': float(a), 'end': float(b)}
+                 for s, a, b in zip(gap_st.tolist(), gap_start, gap_end)],
+        'recovery_correlation': recovery_correlation(rd, rc, period) if rc else {},
+    })
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Coop station log analytics')
+    sub = parser.add_subparsers(dest='cmd', required=True)
+    p = sub.add_parser('ingest', help='convert JSON-lines exports into an archive')
+    p.add_argument('--append', action='store_true', help='merge into an existing archive')
+    p.add_argument('archive')
+    p.add_argument('files', nargs='+')
+    p = sub.add_parser('summary', help='print failure rates, sensor health, gaps and recovery correlation')
+    p.add_argument('archive')
+    p.add_argument('--period', type=float, default=3600, help='resample bin size (s)')
+    p.add_argument('--max-gap', type=float, default=900, help='gap threshold (s)')
+    args = parser.parse_args(argv)
+
+    if args.cmd == 'ingest':
+        counts = ingest(args.archive, args.files, append=args.append)
+        print('Ingested:', counts)
+    else:
+        report = summary(load(args.archive), args.period, args.max_gap)
+        json.dump(report, sys.stdout, indent=2, allow_nan=False)
+        print()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,585 @@
+## gateway.py
+#
+# LAN gateway (CPython, asyncio, stdlib only) that collects readings from
+# many coop stations and forwards them to Blynk in time-windowed batches.
+# Not uploaded to the ESP32.
+#
+# Stations send the packets built by Monitor.send_to_gateway():
+#   {"s": station_id, "b": boot id, "n": seq, "t": time, "d": {"V0": 21.5, ...}}
+# over UDP, or POST one packet (or a JSON list of packets) to /ingest.
+# Binary telemetry frames (telemetry.py) are accepted on both; an HTTP body
+# may hold several frames back to back, e.g. a station's flash buffer.
+#
+# Every `window` seconds the latest values per station are forwarded over a
+# keep-alive HTTP connection pool. Failed forwards are retried, then spooled
+# to disk and re-sent on the next flush, merged with newer values per station
+# (a Blynk batch update only sets current values, so one request per station
+# is enough). Requests Blynk
+# rejects (4xx other than 408/429) are dropped and counted, not spooled.
+#
+# With --archive every accepted reading, including backlog drained from a
+# station's flash buffer (too old to forward), is appended as an
+# analytics.py "reading" line, so the archive can be ingested directly.
+#
+# Usage:
+#   python gateway.py serve --tokens tokens.json --udp 9999 --http 8080
+#   python gateway.py loadtest --stations 500 --duration 10
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+from urllib.parse import quote
+
+import telemetry
+
+BLYNK_HOST = "blynk.cloud"
+BLYNK_PATH = "/external/api/batch/update"
+
+MAX_PACKET = 1024       # bytes per station packet
+MAX_SPOOL = 10000       # spooled stations kept; the stalest are dropped beyond it
+MAX_STATION_ID = 32
+MAX_VALUES = 32
+MAX_STRING = 64         # longest string value (e.g. the V5/V6 timestamps)
+SEEN_WINDOW = 64        # recent (boot, seq) pairs remembered per station
+
+
+def _valid_pin(key):
+    return isinstance(key, str) and len(key) > 1 and key[0] == 'V' and key[1:].isdigit()
+
+
+def _valid_value(v):
+    if isinstance(v, bool):
+        return False
+    if isinstance(v, (int, float)):
+        return v == v and v not in (float('inf'), float('-inf'))
+    return (isinstance(v, str) and len(v) <= MAX_STRING
+            and not any(ord(c) < 0x20 or ord(c) == 0x7F for c in v))
+
+
+def parse_packet(raw):
+    """Decode and validate one datagram / request body.
+
+    Returns a list of reading dicts with keys station, boot, seq, ts, values.
+    Raises ValueError on anything malformed.
+    """
+    if len(raw) > MAX_PACKET * MAX_VALUES:
+        raise ValueError('packet too large')
+    if bytes(raw[:2]) == telemetry.MAGIC:
+        return _parse_frames(raw)
+    try:
+        obj = json.loads(raw)
+    except (UnicodeDecodeError, json.JSONDecodeError) as e:
+        raise ValueError(f'bad json: {e}')
+    packets = obj if isinstance(obj, list) else [obj]
+    readings = []
+    for p in packets:
+        if not isinstance(p, dict):
+            raise ValueError('packet is not an object')
+        station, boot, seq, ts, values = p.get('s'), p.get('b', 0), p.get('n'), p.get('t'), p.get('d')
+        if not isinstance(station, str) or not 0 < len(station) <= MAX_STATION_ID:
+            raise ValueError('bad station id')
+        if not isinstance(boot, int) or not isinstance(seq, int) or seq < 0:
+            raise ValueError('bad boot/seq')
+        if not isinstance(ts, (int, float)) or isinstance(ts, bool):
+            raise ValueError('bad timestamp')
+        if not isinstance(values, dict) or not 0 < len(values) <= MAX_VALUES:
+            raise ValueError('bad values')
+        for k, v in values.items():
+            if not _valid_pin(k) or not _valid_value(v):
+                raise ValueError(f'bad value {k}={v!r}')
+        readings.append({'station': station, 'boot': boot, 'seq': seq, 'ts': ts, 'values': values})
+    return readings
+
+
+def _parse_frames(raw):
+    readings = []
+    for off, _, _, _ in telemetry.iter_frames(raw):
+        for r in telemetry.decode_frame(memoryview(raw)[off:]):
+            r['station'] = str(r['station'])
+            readings.append(r)
+    if not readings:
+        raise ValueError('bad telemetry frame')
+    return readings
+
+
+class Spool:
+    """JSON-lines file holding forwards that failed during an outage.
+
+    Gateway.flush merges it per station, so it holds at most one item per
+    station (capped at max_spool). Items stay on disk until replace() records what is still undelivered, so
+    a crash or cancel mid-flush re-sends rather than loses them.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def put(self, items):
+        if not items:
+            return
+        with open(self.path, 'a') as f:
+            for item in items:
+                f.write(json.dumps(item) + '\n')
+
+    def load(self):
+        """Return everything spooled, oldest first, leaving the file in place."""
+        if not self.path or not os.path.exists(self.path):
+            return []
+        with open(self.path) as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def replace(self, items):
+        """Atomically rewrite the spool with items (removing it when empty)."""
+        if not items:
+            if self.path and os.path.exists(self.path):
+                os.remove(self.path)
+            return
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            for item in items:
+                f.write(json.dumps(item) + '\n')
+        os.replace(tmp, self.path)
+
+    def __len__(self):
+        if not self.path or not os.path.exists(self.path):
+            return 0
+        with open(self.path) as f:
+            return sum(1 for _ in f)
+
+
+class HttpPool:
+    """Minimal keep-alive HTTP/1.1 GET client with a bounded connection pool."""
+
+    def __init__(self, host, port=80, size=16, timeout=10):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self._idle = []
+        self._sem = asyncio.Semaphore(size)
+
+    async def get(self, path):
+        """GET path and return the status code; raises OSError on failure."""
+        async with self._sem:
+            conn = self._idle.pop() if self._idle else None
+            for attempt in range(2):
+                fresh = conn is None
+                if fresh:
+                    conn = await asyncio.wait_for(
+                        asyncio.open_connection(self.host, self.port), self.timeout)
+                reader, writer = conn
+                try:
+                    writer.write(f'GET {path} HTTP/1.1\r\nHost: {self.host}\r\n'
+                                 f'Connection: keep-alive\r\n\r\n'.encode())
+                    await writer.drain()
+                    status, keep = await asyncio.wait_for(self._read_response(reader), self.timeout)
+                except (OSError, ValueError, asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+                    writer.close()
+                    conn = None
+                    if fresh or attempt:
+                        raise OSError(f'http get failed: {e!r}')
+                    continue  # stale keep-alive connection, retry on a new one
+                if keep:
+                    self._idle.append(conn)
+                else:
+                    writer.close()
+                return status
+
+    @staticmethod
+    async def _read_response(reader):
+        status_line = await reader.readline()
+        if not status_line:
+            raise asyncio.IncompleteReadError(b'', None)
+        parts = status_line.split()
+        if len(parts) < 2 or not parts[1].isdigit():
+            raise ValueError(f'bad status line {status_line[:80]!r}')
+        status = int(parts[1])
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            k, _, v = line.decode('latin-1').partition(':')
+            headers[k.strip().lower()] = v.strip().lower()
+        if 'content-length' in headers:
+            await reader.readexactly(int(headers['content-length']))
+        elif headers.get('transfer-encoding') == 'chunked':
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                await reader.readexactly(size + 2)
+                if size == 0:
+                    break
+        else:
+            await reader.read()
+            return status, False
+        return status, headers.get('connection') != 'close'
+
+
+class Rejected(Exception):
+    """The upstream refused an item for good; retrying will not help."""
+
+
+class BlynkForwarder:
+    """Forward one station's values as a single Blynk batch update."""
+
+    def __init__(self, tokens, pool=None):
+        self.tokens = tokens
+        self.pool = pool or HttpPool(BLYNK_HOST)
+
+    async def send(self, station, values):
+        token = self.tokens.get(station)
+        if token is None:
+            print('No Blynk token for station', station)
+            return True  # nothing to retry
+        parts = [f'token={quote(str(token), safe="")}']
+        parts += [f'{quote(k, safe="")}={quote(str(v), safe="")}' for k, v in values.items()]
+        status = await self.pool.get(BLYNK_PATH + '?' + '&'.join(parts))
+        if 400 <= status < 500 and status not in (408, 429):
+            raise Rejected(f'HTTP {status}')
+        return 200 <= status < 300
+
+
+class Gateway:
+    """Validate, deduplicate and batch station readings."""
+
+    def __init__(self, forwarder, window=10, retries=3, retry_delay=0.5,
+                 spool_path='gateway_spool.jsonl', stations=None, archive_path=None,
+                 max_spool=MAX_SPOOL):
+        self.forwarder = forwarder
+        self.window = window
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.spool = Spool(spool_path)
+        self.max_spool = max_spool
+        self.archive_path = archive_path
+        self.allowed = set(stations) if stations else None
+        self.latest = {}    # station -> {'ts', 'seq', 'boot', 'values', 'received'}
+        self.pending = {}   # station -> {'ts', 'values'} waiting for the next flush
+        self._seen = {}     # station -> (set, list) of recent (boot, seq)
+        self.stats = {'packets': 0, 'accepted': 0, 'duplicates': 0, 'invalid': 0, 'stale': 0,
+                      'forwarded': 0, 'rejected': 0, 'failed': 0, 'spooled': 0, 'flushes': 0,
+                      'spool_dropped': 0, 'archive_errors': 0}
+
+    def _is_duplicate(self, station, boot, seq):
+        seen = self._seen.get(station)
+        if seen is None:
+            seen = self._seen[station] = (set(), [])
+        keys, order = seen
+        key = (boot, seq)
+        if key in keys:
+            return True
+        keys.add(key)
+        order.append(key)
+        if len(order) > SEEN_WINDOW:
+            keys.discard(order.pop(0))
+        return False
+
+    def submit(self, raw):
+        """Handle one UDP datagram or HTTP body; returns the number of new readings."""
+        self.stats['packets'] += 1
+        try:
+            readings = parse_packet(raw)
+        except ValueError:
+            self.stats['invalid'] += 1
+            return 0
+        now = time.time()
+        accepted = 0
+        archive = []
+        for r in readings:
+            station = r['station']
+            if self.allowed is not None and station not in self.allowed:
+                self.stats['invalid'] += 1
+                continue
+            if self._is_duplicate(station, r['boot'], r['seq']):
+                self.stats['duplicates'] += 1
+                continue
+            if self.archive_path:
+                archive.append(json.dumps({'station': station, 'ts': r['ts'],
+                                           'kind': 'reading', 'data': r['values']}) + '\n')
+            state = self.latest.get(station)
+            if state is None:
+                state = self.latest[station] = {'values': {}}
+            elif r['ts'] < state['ts'] or (r['ts'] == state['ts'] and r['boot'] == state['boot']
+                                           and r['seq'] < state['seq']):
+                # backlog drained from a station's flash buffer; never overwrite newer values
+                self.stats['stale'] += 1
+                continue
+            state.update(ts=r['ts'], seq=r['seq'], boot=r['boot'], received=now)
+            state['values'].update(r['values'])
+            p = self.pending.get(station)
+            if p is None:
+                p = self.pending[station] = {'station': station, 'values': {}}
+            p['ts'] = r['ts']
+            p['values'].update(r['values'])
+            accepted += 1
+        self.stats['accepted'] += accepted
+        if archive:
+            try:
+                with open(self.archive_path, 'a') as f:
+                    f.writelines(archive)
+            except OSError:
+                self.stats['archive_errors'] += 1
+        return accepted
+
+    async def _forward_one(self, item):
+        """Return True if delivered, None if rejected for good, False to spool."""
+        for attempt in range(self.retries):
+            try:
+                if await self.forwarder.send(item['station'], item['values']):
+                    return True
+            except Rejected as e:
+                print('Forward rejected for', item['station'], e)
+                return None
+            except Exception as e:
+                print('Forward error for', item['station'], e)
+            if attempt < self.retries - 1:
+                await asyncio.sleep(self.retry_delay * (2 ** attempt))
+        return False
+
+    @staticmethod
+    def _merge(items):
+        """Fold items (oldest first) into one per station: latest values win, newest ts kept."""
+        merged = {}
+        for item in items:
+            m = merged.get(item['station'])
+            if m is None:
+                merged[item['station']] = {'station': item['station'], 'ts': item.get('ts'),
+                                           'values': dict(item['values'])}
+                continue
+            m['values'].update(item['values'])
+            ts = item.get('ts')
+            if ts is not None and (m['ts'] is None or ts > m['ts']):
+                m['ts'] = ts
+        return list(merged.values())
+
+    async def flush(self):
+        """Forward everything pending, merged with any spooled items, one request per station.
+
+        Spool file I/O runs in a worker thread. The spool is only rewritten
+        once the forwards finish; if the flush is cancelled, pending items
+        are appended to it first.
+        """
+        self.stats['flushes'] += 1
+        spooled = await asyncio.to_thread(self.spool.load)
+        pending, self.pending = self.pending, {}
+        batch = self._merge(spooled + list(pending.values()))
+        if not batch:
+            return 0
+        try:
+            results = await asyncio.gather(*(self._forward_one(item) for item in batch))
+        except BaseException:
+            self.spool.put(list(pending.values()))
+            raise
+        failed = []
+        for item, ok in zip(batch, results):
+            if ok is None:
+                self.stats['rejected'] += 1
+            elif ok:
+                self.stats['forwarded'] += 1
+            else:
+                failed.append(item)
+        self.stats['failed'] += len(failed)
+        if len(failed) > self.max_spool:
+            failed.sort(key=lambda item: item['ts'] or 0, reverse=True)
+            self.stats['spool_dropped'] += len(failed) - self.max_spool
+            del failed[self.max_spool:]
+        if failed or spooled:
+            await asyncio.to_thread(self.spool.replace, failed)
+        self.stats['spooled'] += len(failed)
+        return len(batch) - len(failed)
+
+    async def run(self):
+        """Flush every `window` seconds until cancelled."""
+        while True:
+            await asyncio.sleep(self.window)
+            await self.flush()
+
+    async def serve_udp(self, host='0.0.0.0', port=9999):
+        gateway = self
+
+        class _Protocol(asyncio.DatagramProtocol):
+            def datagram_received(self, data, addr):
+                gateway.submit(data)
+
+        loop = asyncio.get_running_loop()
+        transport, _ = await loop.create_datagram_endpoint(_Protocol, local_addr=(host, port))
+        return transport
+
+    async def serve_http(self, host='0.0.0.0', port=8080):
+        return await asyncio.start_server(self._handle_http, host, port)
+
+    async def _handle_http(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                method, path = line.decode('latin-1').split()[:2]
+                headers = {}
+                while True:
+                    h = await reader.readline()
+                    if h in (b'\r\n', b'\n', b''):
+                        break
+                    k, _, v = h.decode('latin-1').partition(':')
+                    headers[k.strip().lower()] = v.strip()
+                length = int(headers.get('content-length', 0))
+                if length > MAX_PACKET * MAX_VALUES:
+                    status, body = 413, {'error': 'too large'}
+                    keep = False
+                else:
+                    payload = await reader.readexactly(length) if length else b''
+                    keep = headers.get('connection', '').lower() != 'close'
+                    if method == 'POST' and path == '/ingest':
+                        invalid = self.stats['invalid']
+                        n = self.submit(payload)
+                        if self.stats['invalid'] > invalid:
+                            status, body = 400, {'error': 'invalid packet'}
+                        else:
+                            status, body = 200, {'accepted': n}
+                    elif method == 'GET' and path == '/stations':
+                        status, body = 200, self.latest
+                    elif method == 'GET' and path == '/stats':
+                        spooled = await asyncio.to_thread(len, self.spool)
+                        status, body = 200, dict(self.stats, spool=spooled)
+                    else:
+                        status, body = 404, {'error': 'not found'}
+                data = json.dumps(body).encode()
+                writer.write(f'HTTP/1.1 {status} X\r\nContent-Type: application/json\r\n'
+                             f'Content-Length: {len(data)}\r\n\r\n'.encode() + data)
+                await writer.drain()
+                if not keep:
+                    break
+        except (OSError, ValueError, IndexError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+# --- load test ---------------------------------------------------------
+class CountingForwarder:
+    """Stand-in forwarder for load tests: fixed latency, optional failure rate."""
+
+    def __init__(self, latency=0.05, fail_rate=0.0):
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.sent = 0
+
+    async def send(self, station, values):
+        await asyncio.sleep(self.latency)
+        if random.random() < self.fail_rate:
+            raise OSError('simulated outage')
+        self.sent += 1
+        return True
+
+
+def make_packet(station, boot, seq, values, ts=None):
+    """Build the same packet Monitor.send_to_gateway() sends."""
+    return json.dumps({'s': station, 'b': boot, 'n': seq,
+                       't': time.time() if ts is None else ts, 'd': values}).encode()
+
+
+async def simulate_fleet(host, port, stations=300, interval=1.0, duration=10.0, dup_rate=0.05):
+    """Send readings from `stations` simulated stations over UDP; return packets sent."""
+    loop = asyncio.get_running_loop()
+    transport, _ = await loop.create_datagram_endpoint(
+        asyncio.DatagramProtocol, remote_addr=(host, port))
+    sent = 0
+
+    async def station(i):
+        nonlocal sent
+        name = f'coop{i:04d}'
+        boot = random.getrandbits(16)
+        await asyncio.sleep(random.random() * interval)
+        seq = 0
+        end = loop.time() + duration
+        while loop.time() < end:
+            seq += 1
+            pkt = make_packet(name, boot, seq, {
+                'V0': round(random.gauss(20, 3), 2), 'V1': round(random.gauss(20, 3), 2),
+                'V2': round(random.gauss(18, 4), 2), 'V3': round(random.gauss(1010, 8), 1),
+                'V4': round(random.uniform(30, 90), 1)})
+            transport.sendto(pkt)
+            sent += 1
+            if random.random() < dup_rate:
+                transport.sendto(pkt)
+                sent += 1
+            await asyncio.sleep(interval)
+
+    try:
+        await asyncio.gather(*(station(i) for i in range(stations)))
+    finally:
+        transport.close()
+    return sent
+
+
+async def loadtest(stations=300, interval=1.0, duration=10.0, window=2.0,
+                   latency=0.05, fail_rate=0.0, port=0):
+    """Run a gateway and a simulated fleet in-process; return the gateway stats."""
+    forwarder = CountingForwarder(latency, fail_rate)
+    gw = Gateway(forwarder, window=window, retry_delay=0.05, spool_path='loadtest_spool.jsonl')
+    transport = await gw.serve_udp('127.0.0.1', port)
+    port = transport.get_extra_info('sockname')[1]
+    runner = asyncio.ensure_future(gw.run())
+    t = time.perf_counter()
+    try:
+        sent = await simulate_fleet('127.0.0.1', port, stations, interval, duration)
+        await asyncio.sleep(0.2)
+        runner.cancel()
+        await gw.flush()
+    finally:
+        runner.cancel()
+        transport.close()
+        gw.spool.replace([])
+    elapsed = time.perf_counter() - t
+    return dict(gw.stats, sent=sent, elapsed=round(elapsed, 2),
+                packets_per_sec=round(gw.stats['packets'] / elapsed, 1),
+                stations_seen=len(gw.latest))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Coop station LAN gateway')
+    sub = parser.add_subparsers(dest='cmd', required=True)
+    p = sub.add_parser('serve', help='run the gateway')
+    p.add_argument('--tokens', required=True, help='JSON file: {"station_id": "blynk token"}')
+    p.add_argument('--host', default='0.0.0.0')
+    p.add_argument('--udp', type=int, default=9999)
+    p.add_argument('--http', type=int, default=8080)
+    p.add_argument('--window', type=float, default=10, help='batch window (s)')
+    p.add_argument('--pool', type=int, default=16, help='HTTP connections to Blynk')
+    p.add_argument('--spool', default='gateway_spool.jsonl')
+    p.add_argument('--archive', help='append every accepted reading to this JSON-lines file')
+    p = sub.add_parser('loadtest', help='simulate a station fleet against a local gateway')
+    p.add_argument('--stations', type=int, default=300)
+    p.add_argument('--interval', type=float, default=1.0, help='seconds between readings per station')
+    p.add_argument('--duration', type=float, default=10)
+    p.add_argument('--window', type=float, default=2.0)
+    p.add_argument('--latency', type=float, default=0.05, help='simulated forward latency (s)')
+    p.add_argument('--fail-rate', type=float, default=0.0)
+    args = parser.parse_args(argv)
+
+    if args.cmd == 'loadtest':
+        stats = asyncio.run(loadtest(args.stations, args.interval, args.duration,
+                                     args.window, args.latency, args.fail_rate))
+        print(json.dumps(stats, indent=2))
+        return 0
+
+    with open(args.tokens) as f:
+        tokens = json.load(f)
+
+    async def serve():
+        forwarder = BlynkForwarder(tokens, HttpPool(BLYNK_HOST, size=args.pool))
+        gw = Gateway(forwarder, window=args.window, spool_path=args.spool, stations=tokens,
+                     archive_path=args.archive)
+        await gw.serve_udp(args.host, args.udp)
+        await gw.serve_http(args.host, args.http)
+        print(f'Gateway listening on udp:{args.udp} http:{args.http}')
+        await gw.run()
+
+    asyncio.run(serve())
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
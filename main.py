@@ -24,9 +24,25 @@ connect_wifi([SSID1, SSID2], [PASSWORD, PASSWORD], log=log)
 time.sleep(5)  # give some time before syncing time
 sync_time_chicago(log)
 
+import monitor
 from monitor import Monitor
 
-probe = Monitor(AUTH=BLYNK_AUTH_TOKEN, log=log)
+# Set True to record a sensor trace for host-side replay (see sensor_trace.py)
+RECORD_TRACE = False
+if RECORD_TRACE:
+    from sensor_trace import TraceRecorder
+    TraceRecorder('trace.log').install(monitor)
+
+# Set to ('192.168.1.10', 9999) to upload through a LAN gateway (see gateway.py).
+# BINARY packets (telemetry.py) need a numeric station id; in binary mode
+# unsent readings are kept in BUFFER on flash until the gateway is back.
+GATEWAY = None
+BINARY = False
+BUFFER = 'telemetry.bin' if BINARY else None
+
+probe = Monitor(AUTH=BLYNK_AUTH_TOKEN, log=log, gateway=GATEWAY,
+                station_id=1 if BINARY else 'coop', binary=BINARY,
+                buffer_path=BUFFER)
 print("Initialization log:", probe.log)
 probe.loop_section(wait_time=60)
 
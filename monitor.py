@@ -1,7 +1,9 @@
 import machine
 
 import time
+import json
 import random
+import socket
 import urequests
 from time import sleep
 import onewire
@@ -12,11 +14,13 @@ from bme280 import BME280_I2C
 
 class Monitor:
 
-    def __init__(self, AUTH, log=None):
+    def __init__(self, AUTH, log=None, gateway=None, station_id='coop', binary=False,
+                 buffer_path=None):
         # Track last reboot time for scheduled reboot logic
         self._last_reboot_time = time.time()
         self.ds_sensor_init = False
         self.bme_init = False
+        self._ds_rings = {}  # per-ROM median filter rings
         self.log = log if log is not None else {}
         # Health tracking structure
         if 'health' not in self.log:
@@ -36,6 +40,7 @@ class Monitor:
         self._init_ds18(ds_pin)
         self._init_i2c_and_bme()
         self._init_blynk(AUTH)
+        self._init_gateway(gateway, station_id, binary, buffer_path)
 
     def _init_ds18(self, ds_pin):
         """Initialize DS18B20 sensor bus and LEDs, with retries."""
@@ -56,12 +61,15 @@ class Monitor:
                 print('Retrying DS18B20 initialization in 2 seconds...')
                 sleep(2)
 
+        # keep per-probe quality counts across re-inits
+        quality = self.log.get('ds18b20', {}).get('quality', {})
         self.log['ds18b20'] = {
             'init': self.ds_sensor_init,
             'sensors': len(self.roms),
             'devices': self.roms.copy(),
             'attempts': attempt+1,
-            'addresses': [rom.hex() for rom in self.roms]
+            'addresses': [rom.hex() for rom in self.roms],
+            'quality': quality
         }
 
     def _init_i2c_and_bme(self):
@@ -122,6 +130,8 @@ class Monitor:
         now = time.time()
         if now - self._last_reboot_time > reboot_interval_sec:
             print("[Monitor] Rebooting system after scheduled interval...")
+            if self._gw_buffer is not None:
+                self._gw_buffer.flush()
             machine.reset()
 
     def _init_blynk(self, AUTH):
@@ -130,6 +140,98 @@ class Monitor:
         self.BLYNK_URL = "http://blynk.cloud/external/api/batch/update"
 
 
+    def _init_gateway(self, gateway, station_id, binary=False, buffer_path=None):
+        """Set LAN gateway (host, port) for UDP uploads; None sends straight to Blynk.
+
+        With binary=True packets use the telemetry.py frame format and
+        station_id must be an int (0..65535). buffer_path (binary mode only)
+        names a flash file where readings that could not be sent are kept
+        until the gateway is reachable again.
+        """
+        self.gateway = gateway
+        self.station_id = station_id
+        self._gw_seq = 0
+        self._gw_boot = random.getrandbits(16)  # lets the gateway tell reboots from duplicates
+        self._gw_sock = None
+        self._gw_addr = None
+        self._gw_encoder = None
+        self._gw_buffer = None
+        if gateway and binary:
+            from telemetry import Encoder, FrameBuffer
+            self._gw_encoder = Encoder(station_id, boot=self._gw_boot, capacity=1)
+            if buffer_path:
+                self._gw_buffer = FrameBuffer(buffer_path, station_id, boot=self._gw_boot)
+
+    def send_to_gateway(self, data):
+        """Send a dict of virtual-pin -> value pairs to the LAN gateway as one UDP datagram.
+
+        The packet is compact JSON: {"s": station_id, "b": boot id, "n": seq, "t": time, "d": data},
+        or a single-record telemetry frame when binary mode is on (non-numeric
+        pins such as the V5/V6 timestamps are not sent then).
+        UDP gives no delivery report, so True only means the datagram was sent.
+        In binary mode with a flash buffer, readings that fail to send are
+        buffered and drained after the next successful send.
+        """
+        ts = time.time()
+        enc = self._gw_encoder
+        if enc is not None:
+            enc.reset()
+            if not enc.add(data, ts, self._gw_seq + 1):
+                return False
+            self._gw_seq += 1
+            packet = enc.frame()
+        else:
+            self._gw_seq += 1
+            packet = json.dumps({'s': self.station_id, 'b': self._gw_boot,
+                                 'n': self._gw_seq, 't': ts, 'd': data}).encode()
+        try:
+            if self._gw_sock is None:
+                self._gw_addr = socket.getaddrinfo(self.gateway[0], self.gateway[1])[0][-1]
+                self._gw_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self._gw_sock.sendto(packet, self._gw_addr)
+        except Exception as e:
+            print('Error sending to gateway:', e)
+            self._close_gateway_socket()
+            if self._gw_buffer is not None:
+                self._gw_buffer.add(data, ts, self._gw_seq)
+            return False
+        if self._gw_buffer is not None and self._gw_buffer.pending():
+            self._drain_gateway_buffer()
+        return True
+
+    def _close_gateway_socket(self):
+        # lwIP has only a few sockets; close before dropping the reference
+        if self._gw_sock is not None:
+            try:
+                self._gw_sock.close()
+            except Exception:
+                pass
+        self._gw_sock = None
+
+    def _drain_gateway_buffer(self):
+        """Send buffered frames oldest first; the file is removed only once all were sent.
+
+        A partial drain is resent in full next time; the gateway drops the
+        duplicates and never lets backlog overwrite newer values.
+        """
+        buf = self._gw_buffer
+        try:
+            for frame in buf.frames():
+                self._gw_sock.sendto(frame, self._gw_addr)
+                sleep(0.01)  # let lwIP free its buffers between datagrams
+        except Exception as e:
+            print('Error draining gateway buffer:', e)
+            self._close_gateway_socket()
+            return False
+        buf.clear()
+        return True
+
+    def send(self, data):
+        """Upload via the gateway when configured, otherwise straight to Blynk."""
+        if self.gateway:
+            return self.send_to_gateway(data)
+        return self.send_to_blynk(data)
+
     def send_to_blynk(self, data):
         """Send a dict of virtual-pin -> value pairs to Blynk in one API call.
 
@@ -162,33 +264,150 @@ class Monitor:
             return False
 
     # --- modular sensor read methods ----------------------------------
-    def read_ds(self):
-        """Read DS18B20 sensors and return a list of temperatures.
-
-        Returns a list like [temp1, temp2] (may have 0..N values).
+    # DS18B20 sample quality flags
+    DS_OK = 'ok'            # CRC valid, in range
+    DS_CRC = 'crc'          # scratchpad CRC mismatch (or all-zero line)
+    DS_POR = 'por'          # 85.0 C power-on reset value, no conversion done
+    DS_RANGE = 'range'      # outside the DS18B20 -55..125 C span
+    DS_MISSING = 'missing'  # no presence pulse / bus error
+
+    DS_MIN = -55.0
+    DS_MAX = 125.0
+    DS_FILTER_N = 3         # median-of-N ring size per ROM
+    DS_RING_RESET = 3       # consecutive bad samples before a ROM's ring is cleared
+
+    def _ds_read_scratch(self, rom):
+        """Read one probe's scratchpad and return (temp, flag).
+
+        The CRC is checked here rather than in ds18x20 so a corrupt frame
+        can be told apart from a probe that does not answer at all.
+        """
+        ow = self.ds_sensor.ow
+        buf = bytearray(9)
+        try:
+            ow.reset(True)
+            ow.select_rom(rom)
+            ow.writebyte(0xBE)
+            ow.readinto(buf)
+        except Exception as e:
+            print('ds read error:', e)
+            return None, self.DS_MISSING
+        if ow.crc8(buf) or not any(buf):
+            return None, self.DS_CRC
+        raw = buf[1] << 8 | buf[0]
+        if raw & 0x8000:
+            raw -= 0x10000
+        if rom[0] == 0x10:
+            # DS18S20: 0.5 C steps, refined with COUNT_REMAIN / COUNT_PER_C as in ds18x20
+            if raw == 0x00AA:
+                return None, self.DS_POR
+            if not buf[7]:
+                return None, self.DS_CRC
+            t = (raw >> 1) - 0.25 + (buf[7] - buf[6]) / buf[7]
+        else:
+            if raw == 0x0550:
+                return None, self.DS_POR
+            t = raw / 16
+        if t < self.DS_MIN or t > self.DS_MAX:
+            return None, self.DS_RANGE
+        return t, self.DS_OK
+
+    def _ds_convert_one(self, rom):
+        """Start a conversion on a single probe only (Match ROM + 0x44)."""
+        ow = self.ds_sensor.ow
+        ow.reset(True)
+        ow.select_rom(rom)
+        ow.writebyte(0x44)
+
+    def _ds_ring(self, rom):
+        key = bytes(rom)
+        ring = self._ds_rings.get(key)
+        if ring is None:
+            # [values, next index, consecutive bad samples]
+            ring = self._ds_rings[key] = [[None] * self.DS_FILTER_N, 0, 0]
+        return ring
+
+    def _ds_filter(self, rom, t):
+        """Push t into the fixed ring for rom and return the ring median.
+
+        With an even number of values the two middle ones are averaged.
+        """
+        ring = self._ds_ring(rom)
+        buf, idx = ring[0], ring[1]
+        buf[idx] = t
+        ring[1] = (idx + 1) % self.DS_FILTER_N
+        ring[2] = 0
+        vals = sorted(v for v in buf if v is not None)
+        mid = len(vals) // 2
+        if len(vals) % 2:
+            return vals[mid]
+        return (vals[mid - 1] + vals[mid]) / 2
+
+    def _ds_reject(self, rom):
+        """Count a bad sample; clear the ring after DS_RING_RESET in a row so
+        stale pre-outage values do not pull on the first good reading."""
+        ring = self._ds_ring(rom)
+        ring[2] += 1
+        if ring[2] >= self.DS_RING_RESET:
+            buf = ring[0]
+            for i in range(len(buf)):
+                buf[i] = None
+            ring[1] = 0
+
+    def read_ds_samples(self):
+        """Read DS18B20 sensors and return a list of (temp, flag) tuples.
+
+        Each sample is CRC-checked and range-checked; a failed probe is re-read
+        on its own (with a fresh single-probe conversion after a power-on value)
+        instead of re-converting the whole bus. Good samples go through a
+        median-of-N filter per ROM. temp is None whenever flag != DS_OK.
         """
         try:
             self.ds_sensor.convert_temp()
             sleep(0.75)
-            temps = []
-            for rom in self.roms:
-                try:
-                    temps.append(self.ds_sensor.read_temp(rom))
-                except Exception as e:
-                    print('ds read error:', e)
-                    temps.append(None)
-            # Health tracking
-            if len(temps) == 0 or all(t is None for t in temps):
-                self.log['health']['ds_fail_streak'] += 1
-            else:
-                self.log['health']['ds_fail_streak'] = 0
-                self.log['health']['last_ok_timestamp'] = time.time()
-            return temps
         except Exception as e:
             print('ds convert/read error:', e)
             self.log['health']['ds_fail_streak'] += 1
             return []
 
+        samples = []
+        quality = self.log.setdefault('ds18b20', {}).setdefault('quality', {})
+        for rom in self.roms:
+            t, flag = self._ds_read_scratch(rom)
+            if flag != self.DS_OK:
+                try:
+                    if flag == self.DS_POR:
+                        self._ds_convert_one(rom)
+                        sleep(0.75)
+                    t, flag = self._ds_read_scratch(rom)
+                except Exception as e:
+                    print('ds re-read error:', e)
+                    t, flag = None, self.DS_MISSING
+            if flag == self.DS_OK:
+                t = self._ds_filter(rom, t)
+            else:
+                self._ds_reject(rom)
+                print(f'ds probe {rom.hex()} rejected: {flag}')
+            counts = quality.setdefault(rom.hex(), {})
+            counts[flag] = counts.get(flag, 0) + 1
+            samples.append((t, flag))
+
+        # Health tracking
+        if all(flag != self.DS_OK for _, flag in samples):
+            self.log['health']['ds_fail_streak'] += 1
+        else:
+            self.log['health']['ds_fail_streak'] = 0
+            self.log['health']['last_ok_timestamp'] = time.time()
+        return samples
+
+    def read_ds(self):
+        """Read DS18B20 sensors and return a list of temperatures.
+
+        Returns a list like [temp1, temp2] (may have 0..N values); rejected
+        samples are None. See read_ds_samples() for the quality flags.
+        """
+        return [t for t, _ in self.read_ds_samples()]
+
     def read_bme(self):
         """Read BME sensor and return (temp, pressure, humidity) or None if unavailable."""
         if getattr(self, 'bme', None) is None:
@@ -306,12 +525,12 @@ class Monitor:
         return result
 
     def send_combined(self):
-        """Read all sensors and send a single Blynk payload if any data present."""
+        """Read all sensors and send a single payload (Blynk or gateway) if any data present."""
         data = self.read_all()
         if not data:
             print('No sensor data to send')
             return False
-        ok = self.send_to_blynk(data)
+        ok = self.send(data)
         return ok
 
     def led_blink(self, pin_num=23, times=5, interval=0.2):
@@ -330,12 +549,10 @@ class Monitor:
                 self.led_blink(pin_num=23, times=5, interval=0.15)
 
                 # send blink time of update
-                import time
-
                 t = time.localtime()  # (year, month, mday, hour, min, sec, wday, yday)
                 timestamp = "{:04d}-{:02d}-{:02d}:{:02d}:{:02d}".format(t[0], t[1], t[2], t[3], t[4])
                 print(timestamp)
-                self.send_to_blynk({"V5": f"'{timestamp}'","V6": f"{timestamp}"})
+                self.send({"V5": f"'{timestamp}'","V6": f"{timestamp}"})
 
             # Check if it's time to reboot (default: once per 24h)
             # Attempt sensor recovery if repeated failures detected
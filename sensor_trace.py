@@ -0,0 +1,726 @@
+## sensor_trace.py
+#
+# Sensor trace recording (on the ESP32) and accelerated replay (on a PC).
+#
+# Recording wraps the I2C bus, the 1-Wire bus, urequests and the UDP socket
+# (gateway uploads) used by monitor.py and appends one JSON array per hardware call to a trace file:
+#   {"v": 1, "t0": <device time.time()>}          header, one per boot
+#   {"v": 1, "t0": ..., "rotated": true, "init": n} header of a rotated file
+#   [t_ms, op, key, result]                        successful call
+#   [t_ms, op, key, null, error]                   failed call
+# t_ms is milliseconds since the header; bytes are stored as hex strings.
+# Successful writes, ROM selects, UDP sends and resets with a presence pulse
+# are not recorded (replay assumes success), which keeps the trace compact. When the
+# file reaches max_bytes it is rotated to <path>.1, so at most about twice
+# max_bytes of flash is used. The n calls Monitor.__init__ made at boot
+# (scans, BME calibration reads) are copied below a rotated header, so each
+# file can be replayed without the boot it came from. A write error (e.g.
+# flash full) stops recording rather than failing the monitored call.
+#
+# Replay runs the unmodified Monitor / BME280 / upload code on CPython
+# against fake hardware that answers from the trace, under a virtual clock,
+# so days of operation replay in seconds.
+#
+# Record (device, before creating Monitor):
+#   import monitor, sensor_trace
+#   sensor_trace.TraceRecorder('trace.log').install(monitor)
+#
+# Replay (host, oldest file first; pass the station's gateway settings if
+# it uploads through gateway.py):
+#   python sensor_trace.py trace.log.1 trace.log --wait 60
+#   python sensor_trace.py trace.log --gateway 192.168.1.10:9999 --station-id 1 --binary
+
+import os
+import json
+import time
+
+TRACE_VERSION = 1
+
+# op codes
+I2C_SCAN = 'is'
+I2C_READ = 'ir'
+I2C_WRITE = 'iw'
+OW_SCAN = 'os'
+OW_RESET = 'or'
+OW_SELECT = 'ol'
+OW_WRITE = 'ow'
+OW_READ = 'ob'
+HTTP_GET = 'h'
+UDP_ADDR = 'ua'
+UDP_SEND = 'us'
+
+
+def _hex(b):
+    return bytes(b).hex()
+
+
+# --- recording (device) ------------------------------------------------
+class TraceRecorder:
+    """Append hardware calls made by monitor.py to a trace file."""
+
+    # calls that are only recorded when they fail (or, for resets, see no device)
+    SPARSE = (I2C_WRITE, OW_SELECT, OW_WRITE, OW_RESET, UDP_ADDR, UDP_SEND)
+
+    def __init__(self, path, flush_every=32, max_bytes=256 * 1024, max_init=128):
+        self.path = path
+        self.flush_every = flush_every
+        self.max_bytes = max_bytes
+        self.max_init = max_init
+        self.enabled = True
+        self._pending = []      # (ticks_ms, op, key, result, error)
+        self._init = []         # boot segment as (ms since boot, ...), copied into rotated files
+        self._in_init = True
+        self._init_span = 0
+        try:
+            self._size = os.stat(self.path)[6]
+        except OSError:
+            self._size = 0
+        self._boot = self._start = self._ms()
+        self._append(self._header(time.time()))
+
+    @staticmethod
+    def _ms():
+        if hasattr(time, 'ticks_ms'):
+            return time.ticks_ms()
+        return int(time.time() * 1000)
+
+    @staticmethod
+    def _diff(a, b):
+        if hasattr(time, 'ticks_diff'):
+            return time.ticks_diff(a, b)
+        return a - b
+
+    @staticmethod
+    def _header(t0, **extra):
+        h = {'v': TRACE_VERSION, 't0': t0}
+        h.update(extra)
+        return json.dumps(h) + '\n'
+
+    @staticmethod
+    def _line(t, e):
+        if e[3] is None:
+            return json.dumps([t, e[0], e[1], e[2]]) + '\n'
+        return json.dumps([t, e[0], e[1], None, e[3]]) + '\n'
+
+    def _append(self, text):
+        try:
+            with open(self.path, 'a') as f:
+                f.write(text)
+            self._size += len(text)
+        except Exception as e:
+            self._disable(e)
+
+    def _disable(self, e):
+        print('[Trace] recording disabled:', e)
+        self.enabled = False
+        self._pending = []
+
+    def _rotate(self, first_ms):
+        """Move the file to <path>.1 and start a new one with the boot segment copied in.
+
+        The copy ends just before first_ms, so times in the new file never
+        run backwards and a replay can start from this file alone.
+        """
+        try:
+            os.remove(self.path + '.1')
+        except OSError:
+            pass
+        os.rename(self.path, self.path + '.1')
+        self._size = 0
+        init = None if self._in_init else self._init
+        span = self._init_span if init is not None else 0
+        if hasattr(time, 'ticks_add'):
+            self._start = time.ticks_add(first_ms, -span)
+        else:
+            self._start = first_ms - span
+        t0 = time.time() - self._diff(self._ms(), self._start) / 1000
+        if init is None:
+            text = self._header(t0, rotated=True)
+        else:
+            text = self._header(t0, rotated=True, init=len(init))
+            text += ''.join(self._line(e[0], e[1:]) for e in init)
+        self._append(text)
+
+    def end_init(self):
+        """Mark the end of the boot segment (called when Monitor.__init__ returns)."""
+        if self._in_init:
+            self._in_init = False
+            self._init_span = self._diff(self._ms(), self._boot)
+
+    def event(self, op, key, result=None, error=None):
+        if not self.enabled:
+            return
+        ms = self._ms()
+        if self._in_init and self._init is not None:
+            if len(self._init) < self.max_init:
+                self._init.append((self._diff(ms, self._boot), op, key, result, error))
+            else:
+                self._init = None  # too long to copy; rotated files will not be replayable alone
+        self._pending.append((ms, op, key, result, error))
+        if len(self._pending) >= self.flush_every:
+            self.flush()
+
+    def _format(self, pending):
+        return ''.join(self._line(self._diff(e[0], self._start), e[1:]) for e in pending)
+
+    def flush(self):
+        if not self._pending or not self.enabled:
+            return
+        pending = self._pending
+        self._pending = []
+        try:
+            text = self._format(pending)
+            if self._size and self._size + len(text) > self.max_bytes:
+                # rotate before appending, then re-time the events against the new header
+                self._rotate(pending[0][0])
+                text = self._format(pending)
+            self._append(text)
+        except Exception as e:
+            self._disable(e)
+
+    def call(self, op, key, fn, *args, encode=None):
+        """Run fn(*args), record its outcome and re-raise any error.
+
+        Recording problems never reach the caller; only fn's own errors do.
+        """
+        try:
+            result = fn(*args)
+        except Exception as e:
+            try:
+                self.event(op, key, None, str(e))
+            except Exception as te:
+                self._disable(te)
+            raise
+        try:
+            value = encode(result) if encode else None
+            if op not in self.SPARSE or (op == OW_RESET and not value):
+                self.event(op, key, value)
+        except Exception as te:
+            self._disable(te)
+        return result
+
+    def install(self, monitor_module):
+        """Patch monitor_module so Monitor instances created afterwards are recorded.
+
+        machine.reset() is wrapped to flush pending events before rebooting,
+        and the calls made by the first Monitor.__init__ become the boot
+        segment copied to the top of each rotated file.
+        """
+        rec = self
+        real_i2c = monitor_module.I2C
+        real_onewire = monitor_module.onewire.OneWire
+        real_machine = monitor_module.machine
+
+        class _OneWireModule:
+            @staticmethod
+            def OneWire(pin):
+                return _RecOneWire(real_onewire(pin), rec)
+
+        class _Machine:
+            @staticmethod
+            def reset():
+                rec.flush()
+                real_machine.reset()
+
+            def __getattr__(self, name):
+                return getattr(real_machine, name)
+
+        real_init = monitor_module.Monitor.__init__
+
+        def __init__(monitor, *args, **kwargs):
+            try:
+                real_init(monitor, *args, **kwargs)
+            finally:
+                rec.end_init()
+
+        monitor_module.Monitor.__init__ = __init__
+        monitor_module.I2C = lambda *a, **k: _RecI2C(real_i2c(*a, **k), rec)
+        monitor_module.onewire = _OneWireModule
+        monitor_module.urequests = _RecRequests(monitor_module.urequests, rec)
+        monitor_module.socket = _RecSocketModule(monitor_module.socket, rec)
+        monitor_module.machine = _Machine()
+        return self
+
+
+class _RecI2C:
+    def __init__(self, i2c, rec):
+        self._i2c = i2c
+        self._rec = rec
+
+    def scan(self):
+        return self._rec.call(I2C_SCAN, None, self._i2c.scan, encode=list)
+
+    def readfrom_mem(self, addr, reg, n):
+        return self._rec.call(I2C_READ, [addr, reg, n], self._i2c.readfrom_mem,
+                              addr, reg, n, encode=_hex)
+
+    def writeto_mem(self, addr, reg, buf):
+        return self._rec.call(I2C_WRITE, [addr, reg, _hex(buf)],
+                              self._i2c.writeto_mem, addr, reg, buf)
+
+
+class _RecOneWire:
+    def __init__(self, ow, rec):
+        self._ow = ow
+        self._rec = rec
+        self._rom = None
+
+    def scan(self):
+        return self._rec.call(OW_SCAN, None, self._ow.scan,
+                              encode=lambda roms: [_hex(r) for r in roms])
+
+    def reset(self, required=False):
+        self._rom = None
+        return self._rec.call(OW_RESET, None, self._ow.reset, required,
+                              encode=bool)
+
+    def select_rom(self, rom):
+        self._rom = _hex(rom)
+        return self._rec.call(OW_SELECT, self._rom, self._ow.select_rom, rom)
+
+    def writebyte(self, value):
+        return self._rec.call(OW_WRITE, value, self._ow.writebyte, value)
+
+    def readinto(self, buf):
+        self._rec.call(OW_READ, [self._rom, len(buf)], self._ow.readinto, buf,
+                       encode=lambda _: _hex(buf))
+
+    def crc8(self, data):
+        return self._ow.crc8(data)
+
+    def __getattr__(self, name):
+        # SKIP_ROM, MATCH_ROM, readbit, ... used by ds18x20 and friends
+        return getattr(self._ow, name)
+
+
+class _RecResponse:
+    def __init__(self, resp):
+        self._resp = resp
+        self.status_code = resp.status_code
+
+    def close(self):
+        self._resp.close()
+
+
+class _RecRequests:
+    def __init__(self, urequests, rec):
+        self._urequests = urequests
+        self._rec = rec
+
+    def get(self, url):
+        resp = self._rec.call(HTTP_GET, None, self._urequests.get, url,
+                              encode=lambda r: r.status_code)
+        return _RecResponse(resp)
+
+
+class _RecSocket:
+    def __init__(self, sock, rec):
+        self._sock = sock
+        self._rec = rec
+
+    def sendto(self, data, addr):
+        return self._rec.call(UDP_SEND, None, self._sock.sendto, data, addr)
+
+    def close(self):
+        self._sock.close()
+
+
+class _RecSocketModule:
+    def __init__(self, socket, rec):
+        self._socket = socket
+        self._rec = rec
+
+    def getaddrinfo(self, host, port, *args):
+        return self._rec.call(UDP_ADDR, None, self._socket.getaddrinfo, host, port, *args)
+
+    def socket(self, *args):
+        return _RecSocket(self._socket.socket(*args), self._rec)
+
+    def __getattr__(self, name):
+        # AF_INET, SOCK_DGRAM, ...
+        return getattr(self._socket, name)
+
+
+# --- replay (host) -----------------------------------------------------
+# Both derive from BaseException so the broad `except Exception` handlers in
+# monitor.py cannot swallow them (as with machine.reset() on the device).
+class TraceEnd(BaseException):
+    """The code under replay asked for data the trace does not contain."""
+
+
+class Reboot(BaseException):
+    """machine.reset() was called during replay."""
+
+
+class VirtualClock:
+    """Replacement for the `time` module as seen by monitor.py."""
+
+    def __init__(self, start=0):
+        self.now = start
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+    def localtime(self, t=None):
+        return time.localtime(self.now if t is None else t)
+
+    def advance_to(self, t):
+        if t > self.now:
+            self.now = t
+
+
+class TracePlayer:
+    """Serve recorded outcomes per (op, key) in recorded order.
+
+    Events before the first complete boot segment (a boot header, or a
+    rotated file's copied boot segment) are skipped, since Monitor cannot
+    start without the sensor scans and calibration reads it holds.
+
+    Data-bearing calls (scans, reads, HTTP) raise TraceEnd once their queue
+    is empty. Resets, ROM selects and writes are only recorded when they
+    fail, so they default to success and a recorded failure is served to the
+    first matching call within SPARSE_SLACK seconds of its recorded time.
+    """
+
+    REQUIRED = (I2C_SCAN, I2C_READ, OW_SCAN, OW_READ, HTTP_GET)
+    SPARSE_SLACK = 2.0
+
+    def __init__(self, paths):
+        from collections import deque
+        if isinstance(paths, str):
+            paths = [paths]
+        self.queues = {}
+        self.total = 0
+        self.consumed = 0
+        self.skipped = 0        # events before the first complete boot segment
+        start = None
+        for path in paths:
+            t0 = 0
+            use = start is not None
+            copied = 0
+            with open(path) as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    rec = json.loads(line)
+                    if isinstance(rec, dict):
+                        t0 = rec.get('t0', 0)
+                        copied = 0
+                        if not rec.get('rotated'):
+                            use = True              # a real boot
+                        elif 'init' in rec:
+                            if start is None:
+                                use = True          # replay starts from the copied boot segment
+                            else:
+                                copied = rec['init']  # already served by the real boot
+                        if use and start is None:
+                            start = t0
+                        continue
+                    if copied:
+                        copied -= 1
+                        continue
+                    if not use:
+                        self.skipped += 1
+                        continue
+                    t_ms, op, key, result = rec[:4]
+                    error = rec[4] if len(rec) > 4 else None
+                    q = self.queues.get(self._key(op, key))
+                    if q is None:
+                        q = self.queues[self._key(op, key)] = deque()
+                    q.append((t0 + t_ms / 1000, result, error))
+                    self.total += 1
+        self.clock = VirtualClock(start or 0)
+
+    @staticmethod
+    def _key(op, key):
+        return op + json.dumps(key)
+
+    def take(self, op, key=None):
+        q = self.queues.get(self._key(op, key))
+        if not q:
+            if op in self.REQUIRED:
+                raise TraceEnd(f'trace exhausted at {op} {key}')
+            return None
+        if op not in self.REQUIRED:
+            while q and q[0][0] < self.clock.now - self.SPARSE_SLACK:
+                q.popleft()  # failure recorded for a call the new code never made
+            if not q or q[0][0] > self.clock.now + self.SPARSE_SLACK:
+                return None
+        t, result, error = q.popleft()
+        self.clock.advance_to(t)
+        self.consumed += 1
+        if error is not None:
+            raise OSError(error)
+        return result
+
+
+def _crc8(data):
+    crc = 0
+    for byte in data:
+        for _ in range(8):
+            mix = (crc ^ byte) & 1
+            crc >>= 1
+            if mix:
+                crc ^= 0x8C
+            byte >>= 1
+    return crc
+
+
+class _FakeI2C:
+    def __init__(self, player):
+        self._p = player
+
+    def scan(self):
+        return list(self._p.take(I2C_SCAN))
+
+    def readfrom_mem(self, addr, reg, n):
+        return bytes.fromhex(self._p.take(I2C_READ, [addr, reg, n]))
+
+    def writeto_mem(self, addr, reg, buf):
+        self._p.take(I2C_WRITE, [addr, reg, _hex(buf)])
+
+
+class _FakeOneWire:
+    SKIP_ROM = 0xCC
+
+    def __init__(self, player):
+        self._p = player
+        self._rom = None
+
+    def scan(self):
+        return [bytearray.fromhex(r) for r in self._p.take(OW_SCAN)]
+
+    def reset(self, required=False):
+        self._rom = None
+        r = self._p.take(OW_RESET)
+        return True if r is None else r
+
+    def select_rom(self, rom):
+        self._rom = _hex(rom)
+        self._p.take(OW_SELECT, self._rom)
+
+    def writebyte(self, value):
+        self._p.take(OW_WRITE, value)
+
+    def readinto(self, buf):
+        buf[:] = bytes.fromhex(self._p.take(OW_READ, [self._rom, len(buf)]))
+
+    def crc8(self, data):
+        return _crc8(data)
+
+
+class _FakeDS18X20:
+    """Same bus protocol as micropython-lib ds18x20."""
+
+    def __init__(self, ow):
+        self.ow = ow
+        self.buf = bytearray(9)
+
+    def scan(self):
+        return [rom for rom in self.ow.scan() if rom[0] in (0x10, 0x22, 0x28)]
+
+    def convert_temp(self):
+        self.ow.reset(True)
+        self.ow.writebyte(self.ow.SKIP_ROM)
+        self.ow.writebyte(0x44)
+
+    def read_scratch(self, rom):
+        self.ow.reset(True)
+        self.ow.select_rom(rom)
+        self.ow.writebyte(0xBE)
+        self.ow.readinto(self.buf)
+        if self.ow.crc8(self.buf):
+            raise Exception('CRC error')
+        return self.buf
+
+    def read_temp(self, rom):
+        buf = self.read_scratch(rom)
+        t = buf[1] << 8 | buf[0]
+        if t & 0x8000:
+            t = -((t ^ 0xFFFF) + 1)
+        return t / 16
+
+
+class _FakeSocket:
+    def __init__(self, player, uploads):
+        self._p = player
+        self._uploads = uploads
+
+    def sendto(self, data, addr):
+        try:
+            self._p.take(UDP_SEND)
+        except OSError as e:
+            self._uploads.append((self._p.clock.now, str(e), bytes(data)))
+            raise
+        self._uploads.append((self._p.clock.now, 'sent', bytes(data)))
+        return len(data)
+
+    def close(self):
+        pass
+
+
+class _FakeResponse:
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+    def close(self):
+        pass
+
+
+def _fake_modules(player, uploads):
+    import types
+    import struct
+
+    def module(name, **attrs):
+        m = types.ModuleType(name)
+        m.__dict__.update(attrs)
+        return m
+
+    class Pin:
+        OUT = 1
+        IN = 0
+
+        def __init__(self, *args, **kwargs):
+            pass
+
+        def on(self):
+            pass
+
+        def off(self):
+            pass
+
+    def reset():
+        raise Reboot()
+
+    def get(url):
+        try:
+            status = player.take(HTTP_GET)
+        except OSError as e:
+            uploads.append((player.clock.now, str(e), url))
+            raise
+        uploads.append((player.clock.now, status, url))
+        return _FakeResponse(status)
+
+    def getaddrinfo(host, port, *args):
+        player.take(UDP_ADDR)
+        return [(2, 2, 0, '', (host, port))]
+
+    return {
+        'socket': module('socket', AF_INET=2, SOCK_DGRAM=2, getaddrinfo=getaddrinfo,
+                         socket=lambda *a: _FakeSocket(player, uploads)),
+        'machine': module('machine', Pin=Pin, reset=reset,
+                          I2C=lambda *a, **k: _FakeI2C(player)),
+        'onewire': module('onewire', OneWire=lambda pin: _FakeOneWire(player)),
+        'ds18x20': module('ds18x20', DS18X20=_FakeDS18X20),
+        'urequests': module('urequests', get=get),
+        'network': module('network'),
+        'micropython': module('micropython', const=lambda x: x),
+        'ustruct': module('ustruct', pack=struct.pack, unpack=struct.unpack,
+                          unpack_from=struct.unpack_from),
+    }
+
+
+def replay(path, wait_time=60, auth='replay', quiet=True,
+           gateway=None, station_id='coop', binary=False, buffer_path=None):
+    """Replay a trace (a path, or a list of rotated files oldest first)
+    through Monitor under a virtual clock.
+
+    gateway, station_id, binary and buffer_path are passed to Monitor as on
+    the station; gateway uploads are recorded as (time, 'sent' or error,
+    packet). Monitor is rebuilt with a fresh log after each machine.reset().
+    The run stops when the trace cannot answer a data request. Returns a
+    dict with the uploads made, reboots, the last Monitor log and event counts.
+    """
+    import io
+    import sys
+    import importlib
+    import contextlib
+
+    player = TracePlayer(path)
+    clock = player.clock
+    start = clock.now
+    uploads = []
+    fakes = _fake_modules(player, uploads)
+    fake_socket = fakes.pop('socket')  # bound on monitor only; the host keeps its socket module
+    saved = {name: sys.modules.get(name)
+             for name in list(fakes) + ['utilities', 'bme280', 'monitor']}
+    out = io.StringIO() if quiet else sys.stdout
+    log = {}
+    reboots = 0
+    stopped = None
+    try:
+        sys.modules.update(fakes)
+        for name in ('utilities', 'bme280', 'monitor'):
+            sys.modules.pop(name, None)
+        monitor = importlib.import_module('monitor')
+        monitor.time = clock
+        monitor.sleep = clock.sleep
+        monitor.socket = fake_socket
+        with contextlib.redirect_stdout(out):
+            while stopped is None:
+                log = {}
+                try:
+                    monitor.Monitor(AUTH=auth, log=log, gateway=gateway, station_id=station_id,
+                                    binary=binary, buffer_path=buffer_path
+                                    ).loop_section(wait_time=wait_time)
+                except Reboot:
+                    reboots += 1
+                except TraceEnd as e:
+                    stopped = str(e)
+    finally:
+        for name, mod in saved.items():
+            if mod is None:
+                sys.modules.pop(name, None)
+            else:
+                sys.modules[name] = mod
+    return {
+        'virtual_seconds': clock.now - start,
+        'uploads': uploads,
+        'reboots': reboots,
+        'log': log,
+        'events': player.total,
+        'consumed': player.consumed,
+        'skipped': player.skipped,
+        'stopped': stopped,
+    }
+
+
+def main(argv=None):
+    import argparse
+    import time as host_time
+
+    parser = argparse.ArgumentParser(description='Replay a coop station sensor trace')
+    parser.add_argument('trace', nargs='+', help='trace files, oldest first (trace.log.1 trace.log)')
+    parser.add_argument('--wait', type=float, default=60, help='loop_section wait_time (s)')
+    parser.add_argument('--verbose', action='store_true', help='show Monitor output')
+    parser.add_argument('--gateway', help='host:port the station uploaded to (GATEWAY in main.py)')
+    parser.add_argument('--station-id', default='coop', help='station id (a number with --binary)')
+    parser.add_argument('--binary', action='store_true', help='station sent telemetry frames')
+    parser.add_argument('--buffer', help='host file standing in for the station flash buffer')
+    args = parser.parse_args(argv)
+
+    gateway = None
+    if args.gateway:
+        host, _, port = args.gateway.rpartition(':')
+        gateway = (host, int(port))
+    station_id = int(args.station_id) if args.binary else args.station_id
+    t = host_time.perf_counter()
+    res = replay(args.trace, wait_time=args.wait, quiet=not args.verbose, gateway=gateway,
+                 station_id=station_id, binary=args.binary, buffer_path=args.buffer)
+    elapsed = host_time.perf_counter() - t
+    ok = sum(1 for _, status, _ in res['uploads'] if status in (200, 'sent'))
+    print(f"Replayed {res['virtual_seconds'] / 3600:.1f} h in {elapsed:.2f} s")
+    print(f"Events: {res['consumed']}/{res['events']}  skipped: {res['skipped']}  "
+          f"stopped: {res['stopped']}")
+    print(f"Uploads: {len(res['uploads'])} ({ok} ok)  reboots: {res['reboots']}")
+    print('Health:', res['log'].get('health'))
+    print('Recoveries:', len(res['log'].get('recoveries', [])))
+    return 0
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,375 @@
+## telemetry.py
+#
+# Compact binary telemetry format, shared by the ESP32 and host tools.
+# The same frames are used on the wire (UDP to gateway.py) and for flash
+# buffering: frames are self-delimiting, so a buffer file is just frames
+# appended back to back.
+#
+# Frame (little-endian):
+#   header  <2sBBH   magic b'CW', schema version, record count, boot id
+#   records count x record (layout fixed per schema version)
+#   crc     <I       CRC-32 of header + records
+#
+# Record, schema v1 (24 bytes):
+#   <H station id, I seq, I timestamp, H channel bitmap,
+#   then V0..V4 as fixed-point integers (value * 100):
+#   V0 h, V1 h, V2 h (temps), V3 i (pressure), V4 h (humidity)
+# Bit i of the bitmap is set when channel i holds a value.
+#
+# Device:
+#   enc = Encoder(station_id=1, boot=1234)
+#   enc.add(monitor.read_all())
+#   sock.sendto(enc.frame(), addr); enc.reset()
+#
+#   fb = FrameBuffer('tm.bin', station_id=1, boot=1234)   # flash buffer
+#   fb.add(values, ts, seq)      # frames appended to the file as they fill
+#   for frame in fb.frames(): sock.sendto(frame, addr)
+#   fb.clear()
+#
+# Host:
+#   decode_frame(data)   -> list of reading dicts (pure Python)
+#   decode_frames(data)  -> dict of NumPy columns (vectorized)
+
+import os
+import struct
+import binascii
+
+MAGIC = b'CW'
+VERSION = 1
+HEADER = '<2sBBH'
+HEADER_SIZE = struct.calcsize(HEADER)
+CRC_SIZE = 4
+MAX_RECORDS = 255
+
+# version -> (record struct, channels, scale per channel)
+SCHEMAS = {
+    1: ('<HIIHhhhih', ('V0', 'V1', 'V2', 'V3', 'V4'), (100, 100, 100, 100, 100)),
+}
+_PREFIX = 4  # station, seq, ts, bitmap precede the channel values
+_LIMITS = {'h': (-32768, 32767), 'i': (-2147483648, 2147483647)}
+
+
+def _crc(buf):
+    return binascii.crc32(buf) & 0xFFFFFFFF
+
+
+class Encoder:
+    """Pack readings into a preallocated frame buffer (no per-reading allocation)."""
+
+    def __init__(self, station_id, boot=0, capacity=16, version=VERSION):
+        if not 0 < capacity <= MAX_RECORDS:
+            raise ValueError('capacity must be 1..255')
+        self.station_id = station_id
+        self.boot = boot
+        self.capacity = capacity
+        self.version = version
+        self.fmt, self.channels, self.scales = SCHEMAS[version]
+        self.record_size = struct.calcsize(self.fmt)
+        self.limits = [_LIMITS[c] for c in self.fmt[-len(self.channels):]]
+        self.buf = bytearray(HEADER_SIZE + capacity * self.record_size + CRC_SIZE)
+        self.mv = memoryview(self.buf)
+        self._ints = [0] * len(self.channels)
+        self.seq = 0
+        self.count = 0
+
+    def add(self, values, ts=0, seq=None):
+        """Append one reading ({'V0': 21.5, ...}); unknown keys are ignored.
+
+        seq defaults to the encoder's own counter. Returns False without
+        consuming a sequence number if the frame is full or no channel holds
+        a usable value.
+        """
+        if self.count >= self.capacity:
+            return False
+        ints = self._ints
+        bitmap = 0
+        for i, ch in enumerate(self.channels):
+            ints[i] = 0
+            v = values.get(ch)
+            if v is None:
+                continue
+            try:
+                n = int(round(v * self.scales[i]))
+            except (TypeError, ValueError, OverflowError):
+                continue
+            lo, hi = self.limits[i]
+            if lo <= n <= hi:
+                ints[i] = n
+                bitmap |= 1 << i
+        if not bitmap:
+            return False
+        if seq is None:
+            self.seq += 1
+            seq = self.seq
+        struct.pack_into(self.fmt, self.buf, HEADER_SIZE + self.count * self.record_size,
+                         self.station_id, seq, int(ts), bitmap, *ints)
+        self.count += 1
+        return True
+
+    def frame(self):
+        """Finish the frame and return a memoryview of it (valid until reset/add)."""
+        end = HEADER_SIZE + self.count * self.record_size
+        struct.pack_into(HEADER, self.buf, 0, MAGIC, self.version, self.count, self.boot)
+        struct.pack_into('<I', self.buf, end, _crc(self.mv[:end]))
+        return self.mv[:end + CRC_SIZE]
+
+    def reset(self):
+        self.count = 0
+
+
+class FrameBuffer:
+    """Flash buffer: readings packed into frames appended to a file.
+
+    Up to `capacity` readings are held in RAM before a frame is written, so a
+    power cut loses at most that many; call flush() before a planned reset.
+    Once the file reaches max_bytes, or a write fails, new frames are dropped
+    (counted in `dropped`) so the buffer cannot fill the filesystem.
+    """
+
+    def __init__(self, path, station_id, boot=0, capacity=4, max_bytes=64 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.encoder = Encoder(station_id, boot, capacity)
+        self.dropped = 0
+
+    def _size(self):
+        try:
+            return os.stat(self.path)[6]
+        except OSError:
+            return 0
+
+    def add(self, values, ts=0, seq=None):
+        enc = self.encoder
+        if enc.count >= enc.capacity:
+            self.flush()
+        ok = enc.add(values, ts, seq)
+        if enc.count >= enc.capacity:
+            self.flush()
+        return ok
+
+    def flush(self):
+        """Write the frame being filled, if any, to the file."""
+        enc = self.encoder
+        if not enc.count:
+            return
+        frame = enc.frame()
+        try:
+            if self._size() + len(frame) > self.max_bytes:
+                raise OSError('buffer full')
+            with open(self.path, 'ab') as f:
+                f.write(frame)
+        except OSError:
+            self.dropped += enc.count
+        enc.reset()
+
+    def pending(self):
+        return self.encoder.count > 0 or self._size() > 0
+
+    def frames(self):
+        """Yield each stored frame as bytes, oldest first, one frame in RAM at a time.
+
+        Stops at the first torn or corrupt frame.
+        """
+        self.flush()
+        try:
+            f = open(self.path, 'rb')
+        except OSError:
+            return
+        with f:
+            while True:
+                hdr = f.read(HEADER_SIZE)
+                if len(hdr) < HEADER_SIZE:
+                    return
+                magic, version, count, _ = struct.unpack(HEADER, hdr)
+                schema = SCHEMAS.get(version)
+                if magic != MAGIC or schema is None:
+                    return
+                frame = hdr + f.read(count * struct.calcsize(schema[0]) + CRC_SIZE)
+                if _frame_at(frame, 0) is None:
+                    return
+                yield frame
+
+    def clear(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+def _frame_at(buf, off):
+    """Return (version, count, boot, end) for a valid frame at off, else None."""
+    if len(buf) < off + HEADER_SIZE + CRC_SIZE:
+        return None
+    magic, version, count, boot = struct.unpack_from(HEADER, buf, off)
+    schema = SCHEMAS.get(version)
+    if magic != MAGIC or schema is None:
+        return None
+    end = off + HEADER_SIZE + count * struct.calcsize(schema[0])
+    if len(buf) < end + CRC_SIZE:
+        return None
+    if struct.unpack_from('<I', buf, end)[0] != _crc(memoryview(buf)[off:end]):
+        return None
+    return version, count, boot, end + CRC_SIZE
+
+
+def decode_frame(data):
+    """Decode one frame into reading dicts (station, boot, seq, ts, values).
+
+    Raises ValueError on bad magic, unknown version, truncation or CRC mismatch.
+    """
+    info = _frame_at(data, 0)
+    if info is None:
+        raise ValueError('bad telemetry frame')
+    version, count, boot, _ = info
+    fmt, channels, scales = SCHEMAS[version]
+    size = struct.calcsize(fmt)
+    readings = []
+    for r in range(count):
+        rec = struct.unpack_from(fmt, data, HEADER_SIZE + r * size)
+        station, seq, ts, bitmap = rec[:_PREFIX]
+        values = {}
+        for i, ch in enumerate(channels):
+            if bitmap >> i & 1:
+                values[ch] = rec[_PREFIX + i] / scales[i]
+        readings.append({'station': station, 'boot': boot, 'seq': seq, 'ts': ts, 'values': values})
+    return readings
+
+
+def iter_frames(buf):
+    """Yield (offset, version, count, boot) for each valid frame in buf.
+
+    Corrupt or truncated bytes (e.g. a torn flash write) are skipped by
+    resynchronising on the next magic.
+    """
+    off = 0
+    while True:
+        info = _frame_at(buf, off)
+        if info is not None:
+            version, count, boot, end = info
+            yield off, version, count, boot
+            off = end
+            continue
+        off = buf.find(MAGIC, off + 1)
+        if off < 0:
+            return
+
+
+_CRC_TABLE = None
+
+
+def _crc32_rows(rows):
+    """CRC-32 of every row of a 2-D uint8 array, vectorized over rows."""
+    import numpy as np
+    global _CRC_TABLE
+    if _CRC_TABLE is None:
+        c = np.arange(256, dtype=np.uint32)
+        for _ in range(8):
+            c = np.where(c & 1, np.uint32(0xEDB88320) ^ (c >> 1), c >> 1)
+        _CRC_TABLE = c.astype(np.uint32)
+    crc = np.full(rows.shape[0], 0xFFFFFFFF, dtype=np.uint32)
+    for j in range(rows.shape[1]):
+        crc = _CRC_TABLE[(crc ^ rows[:, j]) & 0xFF] ^ (crc >> 8)
+    return crc ^ np.uint32(0xFFFFFFFF)
+
+
+def _scan_runs(buf, data):
+    """Split buf into runs of back-to-back frames sharing version and count.
+
+    Returns [(offset, n_frames, version, count, valid_mask, boots)]. Headers
+    and CRCs are checked with strided views, so a file of uniform frames
+    (the usual case) is one run with no per-frame Python work.
+    """
+    import numpy as np
+    from numpy.lib.stride_tricks import as_strided
+
+    runs = []
+    off = 0
+    n = len(buf)
+    while True:
+        if n < off + HEADER_SIZE + CRC_SIZE:
+            break
+        magic, version, count, _ = struct.unpack_from(HEADER, buf, off)
+        schema = SCHEMAS.get(version)
+        if magic != MAGIC or schema is None:
+            off = buf.find(MAGIC, off + 1)
+            if off < 0:
+                break
+            continue
+        size = HEADER_SIZE + count * struct.calcsize(schema[0]) + CRC_SIZE
+        k = (n - off) // size
+        if k == 0:
+            off = buf.find(MAGIC, off + 1)
+            if off < 0:
+                break
+            continue
+        frames = as_strided(data[off:], shape=(k, size), strides=(size, 1), writeable=False)
+        same = ((frames[:, 0] == MAGIC[0]) & (frames[:, 1] == MAGIC[1])
+                & (frames[:, 2] == version) & (frames[:, 3] == count))
+        if not same.all():
+            k = int(np.argmin(same))
+            frames = frames[:k]
+        body = frames[:, :size - CRC_SIZE]
+        stored = np.ascontiguousarray(frames[:, size - CRC_SIZE:]).view('<u4').ravel()
+        if size <= 256:
+            valid = _crc32_rows(body) == stored
+        else:  # few, large frames: binascii per frame is cheaper
+            valid = np.fromiter((_crc(memoryview(buf)[off + i * size:off + i * size + size - CRC_SIZE])
+                                 for i in range(k)), dtype=np.uint32, count=k) == stored
+        boots = np.ascontiguousarray(frames[:, 4:6]).view('<u2').ravel()
+        runs.append((off, k, version, count, valid, boots))
+        off += k * size
+        if not valid[-1]:
+            # the last frame may be a torn write; resync from just after its header
+            off = buf.find(MAGIC, off - size + 1)
+            if off < 0:
+                break
+    return runs
+
+
+def decode_frames(buf):
+    """Vectorized decode of concatenated frames (host only, needs NumPy).
+
+    Returns a dict of equal-length columns: station, boot, seq, ts, and one
+    float64 column per channel with NaN where the bitmap bit is clear.
+    Records are read through strided structured views of buf; memory is the
+    output columns plus one copy of the valid records per run.
+    """
+    import numpy as np
+
+    buf = bytes(buf)
+    data = np.frombuffer(buf, dtype=np.uint8)
+    runs = _scan_runs(buf, data)
+    total = sum(int(r[4].sum()) * r[3] for r in runs)
+    channels = []
+    for r in runs:
+        channels.extend(ch for ch in SCHEMAS[r[2]][1] if ch not in channels)
+    out = {'station': np.empty(total, np.uint16), 'boot': np.empty(total, np.uint16),
+           'seq': np.empty(total, np.uint32), 'ts': np.empty(total, np.float64)}
+    for ch in channels:
+        out[ch] = np.full(total, np.nan)
+
+    pos = 0
+    for off, k, version, count, valid, boots in runs:
+        fmt, chans, scales = SCHEMAS[version]
+        rsize = struct.calcsize(fmt)
+        fsize = HEADER_SIZE + count * rsize + CRC_SIZE
+        names = ['station', 'seq', 'ts', 'bitmap'] + list(chans)
+        dtype = np.dtype([(nm, '<' + t) for nm, t in zip(names, fmt[1:])])
+        view = np.ndarray(shape=(k, count), dtype=dtype, buffer=buf,
+                          offset=off + HEADER_SIZE, strides=(fsize, rsize))
+        rec = view[valid].ravel()
+        m = len(rec)
+        if not m:
+            continue
+        sl = slice(pos, pos + m)
+        out['station'][sl] = rec['station']
+        out['boot'][sl] = np.repeat(boots[valid], count)
+        out['seq'][sl] = rec['seq']
+        out['ts'][sl] = rec['ts']
+        bitmap = rec['bitmap']
+        for i, ch in enumerate(chans):
+            col = out[ch][sl]
+            present = (bitmap >> i) & 1 == 1
+            col[present] = rec[ch][present] / scales[i]
+        pos += m
+    return out